@@ -5,8 +5,11 @@ Copyright (C) 2020-2021 Koen Vervloesem
 SPDX-License-Identifier: MIT
 """
 # pragma pylint: disable=no-member,no-name-in-module
+import os
+import warnings
 from enum import IntEnum
-from time import sleep
+from functools import lru_cache
+from time import perf_counter, sleep
 
 import RPi.GPIO as GPIO
 from RPi.GPIO import HIGH, IN, LOW, OUT
@@ -28,11 +31,50 @@ LEVEL_TAB = [
     0b00011111,
     0b00111111,
     0b01111111,
+    0b11111111,
 ]
 
+# For every byte, the states of CLK and DIO at the start of each bit, in the
+# order the bits are sent to the IC: LSB first.
+BIT_STATES_TAB = tuple(
+    tuple((LOW, (byte >> bit) & 0x01) for bit in range(8)) for byte in range(256)
+)
+
 # The IC's maximum frequency is 500 kHz with a 50% duty cycle.
 # We take a conservative clock cycle here.
 CLOCK_CYCLE = 0.000050  # 50 microseconds
+# The delays between the edges of the clock signal, computed once.
+HALF_CYCLE = CLOCK_CYCLE / 2
+QUARTER_CYCLE = CLOCK_CYCLE / 4
+
+
+# Set the environment variable RPIBD_BUSYWAIT to 0 to use time.sleep instead.
+_BUSY_WAIT = os.environ.get("RPIBD_BUSYWAIT", "1") != "0"
+
+
+def _delay(seconds):
+    """Wait for a number of seconds.
+
+    time.sleep can't reliably wait for less than about 100 microseconds on a
+    Raspberry Pi, which makes a clock cycle of the serial bus take much longer
+    than needed. So by default we spin on a monotonic clock instead."""
+    if not _BUSY_WAIT:
+        sleep(seconds)
+        return
+
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        pass
+
+
+def _validate_pin(pin, name):
+    """Raise InvalidPinError if pin isn't a BCM pin number from 0 to 27.
+
+    name is the name of the pin to use in the error message."""
+    if pin not in range(28):
+        raise InvalidPinError(
+            pin, "{} pin should be a number from 0 to 27.".format(name)
+        )
 
 
 class Command(IntEnum):
@@ -47,6 +89,33 @@ class Command(IntEnum):
     ADDR_START = 0xC0  # Set address of the display register
 
 
+# Plain int values of the commands, to keep enum members out of the hot path.
+_ADDR_FIXED = int(Command.ADDR_FIXED)
+_DISPLAY_ON = int(Command.DISPLAY_ON)
+_ADDR_START = int(Command.ADDR_START)
+
+
+@lru_cache(maxsize=None)
+def _level_commands(segments, brightness):
+    """Return the commands to display every level from 0 to segments.
+
+    The commands only depend on the number of segments and the brightness,
+    so they're computed once and shared by all display objects.
+
+    Every command is stored as bytes, which the write loop iterates over as
+    plain ints."""
+    # Only GRID1 is connected, so auto-increment address mode wouldn't save
+    # a transmission: the address command and the data byte already share
+    # one, and the datasheet requires the data command and display control
+    # command to be sent on their own.
+    data_command = bytes((_ADDR_FIXED,))
+    display_command = bytes((_DISPLAY_ON + brightness,))
+    return tuple(
+        (data_command, bytes((_ADDR_START, LEVEL_TAB[level])), display_command)
+        for level in range(segments + 1)
+    )
+
+
 class Brightness(IntEnum):
     """An enumeration of brightness values for the display."""
 
@@ -72,27 +141,32 @@ class BatteryDisplay:
     Pins K1 and K2 (for key input, the latter only for the TM1637) are not connected.
     """
 
-    def __init__(self, clock_pin=24, data_pin=23, segments=7):
+    def __init__(self, clock_pin=24, data_pin=23, segments=7, high_priority=False):
         """Initialize the battery display object.
 
-        clock_pin and data_pin should be BCM pin numbers from 0 to 27."""
-        if clock_pin not in range(28):
-            raise InvalidPinError(
-                clock_pin, "Clock pin should be a number from 0 to 27."
-            )
+        clock_pin and data_pin should be BCM pin numbers from 0 to 27.
+
+        If high_priority is True, transmissions to the IC run with the real-time
+        scheduling policy SCHED_FIFO to reduce timing jitter. This requires root
+        permissions; without them the normal scheduling policy is used."""
+        _validate_pin(clock_pin, "Clock")
         self.clock_pin = clock_pin
 
-        if data_pin not in range(28):
-            raise InvalidPinError(data_pin, "Data pin should be a number from 0 to 27.")
+        _validate_pin(data_pin, "Data")
         self.data_pin = data_pin
 
-        if segments + 1 not in range(8):
+        if segments not in range(1, 9):
             raise InvalidSegmentsError(segments)
         self.segments = segments
 
+        self.high_priority = high_priority
+
+        # The last level that has been written successfully, if any.
+        self._last_level = None
+
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(clock_pin, OUT)
-        GPIO.setup(data_pin, OUT)
+        # Both lines are HIGH when the bus is idle.
+        GPIO.setup([clock_pin, data_pin], OUT, initial=HIGH)
 
         self.set_brightness(Brightness.DARK)
         ack = self.clear_display()
@@ -118,55 +192,108 @@ class BatteryDisplay:
             raise InvalidBrightnessError(brightness)
         self.brightness = brightness
 
+        self._level_frames = _level_commands(self.segments, brightness)
+        # The new brightness has to be sent with the next level.
+        self._last_level = None
+
     def send_command(self, *data):
         """Send a command and optional data to the IC.
 
+        Returns True if the IC has sent an ACK after each written byte.
+        The transmission is stopped at the first byte without ACK."""
+        # The command can change what the display shows, so the next level has
+        # to be sent again.
+        self._last_level = None
+        return self._send(data)
+
+    def _send(self, data):
+        """Send a sequence of bytes to the IC in one transmission.
+
         Returns True if the IC has sent an ACK after each written byte."""
         ack = True
 
-        self.start()
-        for byte in data:
-            ack = self.write_byte(byte) and ack
-        self.stop()
+        policy, param = self._raise_priority()
+        try:
+            write_byte = self.write_byte
+            self.start()
+            for byte in data:
+                if not write_byte(byte):
+                    ack = False
+                    break
+            self.stop()
+        finally:
+            if policy is not None:
+                os.sched_setscheduler(0, policy, param)
 
         return ack
 
+    def _raise_priority(self):
+        """Switch the process to the real-time scheduling policy SCHED_FIFO.
+
+        Only does this if high_priority is True. Returns the previous policy and
+        its parameters, or (None, None) if the policy hasn't been changed.
+        If the process isn't allowed to change its policy, a warning is emitted
+        and high_priority is disabled so we don't try again for every
+        transmission."""
+        if not self.high_priority:
+            return None, None
+
+        policy = os.sched_getscheduler(0)
+        param = os.sched_getparam(0)
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(50))
+        except PermissionError:
+            warnings.warn(
+                "SCHED_FIFO requires root; continuing with the normal scheduling policy"
+            )
+            self.high_priority = False
+            return None, None
+
+        return policy, param
+
     def clear_display(self):
         """Clear the display.
 
         Returns True if the IC has sent an ACK after the write."""
         return self.set_level(0)
 
-    def set_level(self, level):
+    def set_level(self, level, force=False):
         """Display a level on the battery display.
 
         level should be an integer from 0 to the number of LED segments.
 
-        Returns True if the IC has sent an ACK after every write."""
-        if level not in range(self.segments):
+        If the level is already displayed, nothing is sent to the IC, unless
+        force is True.
+
+        Returns True if the IC has sent an ACK after every write.
+        No more commands are sent after a write without ACK."""
+        if level not in range(self.segments + 1):
             raise InvalidLevelError(level)
 
-        ack = True
+        if level == self._last_level and not force:
+            return True
 
-        ack = self.send_command(Command.ADDR_FIXED) and ack
-        ack = self.send_command(Command.ADDR_START, LEVEL_TAB[level]) and ack
-        ack = self.send_command(Command.DISPLAY_ON + self.brightness) and ack
+        for command in self._level_frames[level]:
+            if not self._send(command):
+                self._last_level = None
+                return False
 
-        return ack
+        self._last_level = level
+        return True
 
     def half_cycle_clock_low(self, write_data):
         """Start the first half cycle when the clock is low and write a data bit."""
-        self.set_clock(LOW)
-        sleep(CLOCK_CYCLE / 4)
+        GPIO.output(self.clock_pin, LOW)
+        _delay(QUARTER_CYCLE)
 
-        self.set_data(write_data)
-        sleep(CLOCK_CYCLE / 4)
+        GPIO.output(self.data_pin, write_data)
+        _delay(QUARTER_CYCLE)
 
     def half_cycle_clock_high(self):
         """Start the second half cycle when the clock is high."""
 
-        self.set_clock(HIGH)
-        sleep(CLOCK_CYCLE / 2)
+        GPIO.output(self.clock_pin, HIGH)
+        _delay(HALF_CYCLE)
 
     def half_cycle_clock_high_ack(self):
         """Start the second half cycle when the clock is high and check for the ack.
@@ -174,8 +301,8 @@ class BatteryDisplay:
         Returns the ack bit (should be LOW)."""
 
         # Set CLK high.
-        self.set_clock(HIGH)
-        sleep(CLOCK_CYCLE / 4)
+        GPIO.output(self.clock_pin, HIGH)
+        _delay(QUARTER_CYCLE)
 
         # Set DIO to input mode and check the ack.
         GPIO.setup(self.data_pin, IN)
@@ -184,13 +311,13 @@ class BatteryDisplay:
         # ack (DIO) should be LOW now
         # Now we have to set it to LOW ourselves before the IC
         # releases the port line at the next clock cycle.
-        GPIO.setup(self.data_pin, OUT)
-        if not ack:
-            self.set_data(LOW)
+        # Switching DIO back to output mode with the level we've just read
+        # does this without an extra write.
+        GPIO.setup(self.data_pin, OUT, initial=ack)
 
-        sleep(CLOCK_CYCLE / 4)
+        _delay(QUARTER_CYCLE)
         # Set CLK to low again so it can begin the next cycle.
-        self.set_clock(LOW)
+        GPIO.output(self.clock_pin, LOW)
 
         return ack
 
@@ -203,12 +330,22 @@ class BatteryDisplay:
         # E.g. write 1 to DIO:
         # CLK ____████
         # DIO __██████
-        for _ in range(8):
-            self.half_cycle_clock_low(write_data & 0x01)
-            self.half_cycle_clock_high()
-
-            # Take the next bit.
-            write_data >>= 1
+        # The pins are toggled directly here instead of through method calls,
+        # because this loop is the hot path of every transmission.
+        # Setting CLK LOW and DIO happens in one call: RPi.GPIO sets the channels
+        # in the order of the list, so DIO only changes after CLK is LOW.
+        # CLK goes HIGH in a separate call after a delay, because DIO has to be
+        # stable for a while before the rising edge of CLK.
+        clock_pin = self.clock_pin
+        data_pin = self.data_pin
+        pins = (clock_pin, data_pin)
+        output = GPIO.output
+        wait = _delay
+        for states in BIT_STATES_TAB[write_data]:
+            output(pins, states)
+            wait(HALF_CYCLE)
+            output(clock_pin, HIGH)
+            wait(HALF_CYCLE)
 
         # After writing 8 bits, start a 9th clock ycle.
         # During the 9th half-cycle of CLK when it is LOW,
@@ -217,35 +354,46 @@ class BatteryDisplay:
         # CLK ____████
         # DIO __█_____
         # Set CLK low, DIO high.
-        self.half_cycle_clock_low(HIGH)
+        output(pins, (LOW, HIGH))
+        wait(HALF_CYCLE)
+
         # Return True if the ACK was LOW.
         return not self.half_cycle_clock_high_ack()
 
-    def delineate_transmission(self, begin):
-        """Delineate a data transmission to the IC.
-
-        The begin parameter is a boolean with the start value of DIO.
-        """
-        # DIO changes its value while CLK is HIGH.
-        self.set_data(begin)
-        sleep(CLOCK_CYCLE / 2)
-
-        self.set_clock(HIGH)
-        sleep(CLOCK_CYCLE / 4)
-
-        self.set_data(not begin)
-        sleep(CLOCK_CYCLE / 4)
-
     def start(self):
         """Start a data transmission to the IC."""
         # DIO changes from HIGH to low while CLK is high.
         # CLK ____████
         # DIO ██████__
-        self.delineate_transmission(HIGH)
+        GPIO.output(self.data_pin, HIGH)
+        _delay(HALF_CYCLE)
+
+        GPIO.output(self.clock_pin, HIGH)
+        _delay(QUARTER_CYCLE)
+
+        GPIO.output(self.data_pin, LOW)
+        _delay(QUARTER_CYCLE)
 
     def stop(self):
         """Stop a data transmission to the IC."""
         # DIO changes from LOW to HIGH while CLK is HIGH.
         # CLK ____████
         # DIO ______██
-        self.delineate_transmission(LOW)
+        GPIO.output(self.data_pin, LOW)
+        _delay(HALF_CYCLE)
+
+        GPIO.output(self.clock_pin, HIGH)
+        _delay(QUARTER_CYCLE)
+
+        GPIO.output(self.data_pin, HIGH)
+        _delay(QUARTER_CYCLE)
+
+
+def tm1651(clock_pin=24, data_pin=23, high_priority=False):
+    """Create a battery display object for a TM1651, which drives 7 LED segments."""
+    return BatteryDisplay(clock_pin, data_pin, 7, high_priority)
+
+
+def tm1637(clock_pin=24, data_pin=23, high_priority=False):
+    """Create a battery display object for a TM1637, which drives 8 LED segments."""
+    return BatteryDisplay(clock_pin, data_pin, 8, high_priority)
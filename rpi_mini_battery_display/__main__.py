@@ -5,10 +5,11 @@ Copyright (C) 2020-2021 Koen Vervloesem
 SPDX-License-Identifier: MIT
 """
 import argparse
+import os
+import signal
 import sys
 from time import sleep
 
-from psutil import cpu_percent
 from RPi.GPIO import cleanup  # pylint: disable=no-name-in-module
 
 from rpi_mini_battery_display import BatteryDisplay
@@ -21,8 +22,46 @@ from rpi_mini_battery_display.exceptions import (
 )
 
 
-def main():
-    """Main method."""
+def cpu_times():
+    """Return the busy and total CPU time of the system from /proc/stat."""
+    with open("/proc/stat", "rb") as stat_file:
+        # user nice system idle iowait irq softirq steal guest guest_nice
+        times = [int(time) for time in stat_file.readline().split()[1:9]]
+
+    # Guest time is already included in user and nice time.
+    total = sum(times)
+    return total - times[3] - times[4], total
+
+
+def cpu_level(previous_times, times, segments):
+    """Return the CPU usage between two results of cpu_times() as a level.
+
+    A percentage from 0 to 100 is mapped to a level from 0 to segments, with
+    integer arithmetic so the boundaries between levels are exact."""
+    busy = times[0] - previous_times[0]
+    total = times[1] - previous_times[1]
+    if total <= 0:
+        return 0
+
+    return min(busy * (segments + 1) // total, segments)
+
+
+def show_cpu_percentage(display, segments):
+    """Show the CPU percentage on the display until the program is stopped."""
+    times = cpu_times()
+    while True:
+        previous_times, times = times, cpu_times()
+        display.set_level(cpu_level(previous_times, times, segments))
+        sleep(2)
+
+
+def stop(_signal_number, _frame):
+    """Stop the program on SIGTERM the same way as on Ctrl+C."""
+    raise KeyboardInterrupt
+
+
+def parse_args():
+    """Parse the command-line arguments."""
     parser = argparse.ArgumentParser(
         prog="rpi-mini-battery-display",
         description="Control a mini battery display with TM1651 or TM1637 chip",
@@ -53,7 +92,20 @@ def main():
         "--segments",
         type=int,
         default=7,
-        help="Number of LED segments (default: 7, range: 1-7)",
+        help="Number of LED segments (default: 7, range: 1-8)",
+    )
+    parser.add_argument(
+        "-r",
+        "--real-time",
+        action="store_true",
+        help="Send data to the display with real-time priority (requires root)",
+    )
+    parser.add_argument(
+        "-a",
+        "--cpu-affinity",
+        type=int,
+        metavar="CPU",
+        help="Only run on this CPU core",
     )
 
     command = parser.add_mutually_exclusive_group(required=True)
@@ -67,19 +119,51 @@ def main():
 
     args = parser.parse_args()
 
+    # Don't check against os.sched_getaffinity: cores isolated with isolcpus
+    # aren't in the affinity mask of the shell, but we can still run on them.
+    available_cpus = range(os.cpu_count())
+    if args.cpu_affinity is not None and args.cpu_affinity not in available_cpus:
+        parser.error("CPU core {} isn't available".format(args.cpu_affinity))
+
+    return args
+
+
+def set_cpu_affinity(cpu):
+    """Only run the program on the given CPU core, if it's not None.
+
+    Exits the program if the process isn't allowed to run on this core."""
+    if cpu is not None:
+        # Pinning the program to a core that is isolated from the scheduler
+        # reduces timing jitter on the serial bus.
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except OSError as error:
+            print("Can't run on CPU core {}: {}".format(cpu, error.strerror))
+            sys.exit(6)
+
+
+def main():
+    """Main method."""
+    args = parse_args()
+
+    # Interrupt the 2-second sleep of the CPU percentage loop immediately on
+    # SIGTERM too, so the GPIO pins are cleaned up before the program exits.
+    signal.signal(signal.SIGTERM, stop)
+
+    # This happens before the GPIO pins are set up, so there's nothing to clean
+    # up if it fails.
+    set_cpu_affinity(args.cpu_affinity)
+
     exit_code = 0
     try:
-        display = BatteryDisplay(args.clock_pin, args.data_pin, args.segments)
+        display = BatteryDisplay(
+            args.clock_pin, args.data_pin, args.segments, args.real_time
+        )
         display.set_brightness(args.brightness)
         if args.level:
             display.set_level(args.level)
         elif args.processor:
-            while True:
-                # Map a percentage from 0 to 100 to a level from 0 to number of segments
-                display.set_level(
-                    min(int(cpu_percent() / 100 * (args.segments + 1)), args.segments)
-                )
-                sleep(2)
+            show_cpu_percentage(display, args.segments)
     except InvalidPinError as error:
         print("Invalid pin number: {}. {}".format(error.pin, str(error)))
         exit_code = 1